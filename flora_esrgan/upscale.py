@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import gc
 import logging
+import math
 import sys
 from collections import OrderedDict
 from enum import Enum
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
@@ -22,6 +24,9 @@ from .utils.architecture.SRVGG import SRVGGNetCompact as RealESRGANv2
 
 from PIL import Image
 
+# Loaded models, keyed by (model path, device, fp16, compile_model)
+_MODEL_CACHE: Dict[Tuple[str, str, bool, bool], torch.nn.Module] = {}
+
 
 class SeamlessOptions(str, Enum):
     TILE = "tile"
@@ -37,19 +42,29 @@ class AlphaOptions(str, Enum):
     SWAPPING = "swapping"
 
 
+class ReturnType(str, Enum):
+    PIL = "pil"
+    NDARRAY = "ndarray"
+    TENSOR = "tensor"
+
+
 class Upscale:
     model_str: str = None
-    input: Image = None
+    input: Union[Image.Image, np.ndarray, torch.Tensor] = None
     seamless: SeamlessOptions = None
     cpu: bool = None
     fp16: bool = None
+    compile_model: bool = None
     # device_id: int = None
-    cache_max_split_depth: bool = None
     binary_alpha: bool = None
     ternary_alpha: bool = None
     alpha_threshold: float = None
     alpha_boundary_offset: float = None
     alpha_mode: AlphaOptions = None
+    tile_size: int = None
+    tile_pad: int = None
+    batch_size: int = None
+    return_type: ReturnType = None
     log: logging.Logger = None
 
     device: torch.device = None
@@ -67,10 +82,11 @@ class Upscale:
     def __init__(
         self,
         model: str,
-        input: Image,
+        input: Union[Image.Image, np.ndarray, torch.Tensor],
         seamless: Optional[SeamlessOptions] = None,
         cpu: bool = False,
         fp16: bool = False,
+        compile_model: bool = False,
         device_id: int = 0,
         cache_max_split_depth: bool = False,
         binary_alpha: bool = False,
@@ -78,6 +94,10 @@ class Upscale:
         alpha_threshold: float = 0.5,
         alpha_boundary_offset: float = 0.2,
         alpha_mode: Optional[AlphaOptions] = None,
+        tile_size: int = 512,
+        tile_pad: int = 32,
+        batch_size: int = 4,
+        return_type: ReturnType = ReturnType.PIL,
         log: logging.Logger = logging.getLogger(),
     ) -> None:
         self.model_str = model
@@ -85,168 +105,462 @@ class Upscale:
         self.seamless = seamless
         self.cpu = cpu
         self.fp16 = fp16
+        self.compile_model = compile_model and not cpu
         self.device = torch.device("cpu" if self.cpu else f"cuda:{device_id}")
-        self.cache_max_split_depth = cache_max_split_depth
         self.binary_alpha = binary_alpha
         self.ternary_alpha = ternary_alpha
         self.alpha_threshold = alpha_threshold
         self.alpha_boundary_offset = alpha_boundary_offset
         self.alpha_mode = alpha_mode
+        self.tile_size = tile_size
+        self.tile_pad = tile_pad
+        self.batch_size = batch_size
+        self.return_type = return_type
         self.log = log
-        if self.fp16:
-            torch.set_default_tensor_type(
-                torch.HalfTensor if self.cpu else torch.cuda.HalfTensor
+        if cache_max_split_depth:
+            self.log.warning(
+                "cache_max_split_depth is deprecated and ignored, images are now "
+                "upscaled in fixed tiles (see tile_size and batch_size)"
             )
-        
+        # Let FP32 matmuls use TF32 on Ampere and newer
+        torch.set_float32_matmul_precision("high")
+        # Tile sides are rounded to multiples of 64 (see _tile_side), so let cuDNN
+        # benchmark and cache the fastest algorithm for each
+        torch.backends.cudnn.benchmark = True
+
+        # Host -> device copies, compute and device -> host copies each get their own
+        # stream so consecutive batches overlap. Two slots of pinned staging buffers
+        # are ping-ponged between batches.
+        if not self.cpu:
+            self._h2d_stream = torch.cuda.Stream(self.device)
+            self._compute_stream = torch.cuda.Stream(self.device)
+            self._d2h_stream = torch.cuda.Stream(self.device)
+        self._slots = []
+        self._slot = 0
+
         # Load the model so we can access the scale
         self.load_model(self.model_str)
 
 
-    def run(self) -> None:
-
-        # Store the maximum split depths for each model in the chain
-        # TODO: there might be a better way of doing this but it's good enough for now
-        split_depths = {}
+    def run(self) -> Union[Image.Image, np.ndarray, torch.Tensor]:
 
         # read image
         # We use imdecode instead of imread to work around Unicode breakage on Windows.
         # See https://jdhao.github.io/2019/09/11/opencv_unicode_image_path/
         # img = cv2.imdecode(np.fromfile(str(img_path.absolute()), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-        img = np.array(self.input)
-        if len(img.shape) < 3:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-
-        # Seamless modes
-        if self.seamless == SeamlessOptions.TILE:
-            img = cv2.copyMakeBorder(img, 16, 16, 16, 16, cv2.BORDER_WRAP)
-        elif self.seamless == SeamlessOptions.MIRROR:
-            img = cv2.copyMakeBorder(
-                img, 16, 16, 16, 16, cv2.BORDER_REFLECT_101
-            )
-        elif self.seamless == SeamlessOptions.REPLICATE:
-            img = cv2.copyMakeBorder(img, 16, 16, 16, 16, cv2.BORDER_REPLICATE)
-        elif self.seamless == SeamlessOptions.ALPHA_PAD:
-            img = cv2.copyMakeBorder(
-                img, 16, 16, 16, 16, cv2.BORDER_CONSTANT, value=[0, 0, 0, 0]
-            )
-        final_scale: int = 1
-
-        img_height, img_width = img.shape[:2]
-
-        if self.cache_max_split_depth and len(split_depths.keys()) > 0:
-            rlt, depth = ops.auto_split_upscale(
-                img,
-                self.upscale,
-                self.last_scale,
-                max_depth=split_depths[0],
-            )
+        # HWC arrays and tensors are used as-is, without a copy
+        if isinstance(self.input, np.ndarray):
+            img = self.input
+        elif torch.is_tensor(self.input):
+            img = self.input.detach().cpu().numpy()
         else:
-            rlt, depth = ops.auto_split_upscale(
-                img, self.upscale, self.last_scale
+            img = np.asarray(self.input)
+        if img.ndim not in (2, 3) or (img.ndim == 3 and img.shape[2] > 4):
+            raise ValueError(
+                "Expected an HxW or HxWxC image with up to 4 channels, "
+                f"got shape {img.shape}"
             )
-            split_depths[0] = depth
-
-        final_scale *= self.last_scale
 
-        # This is for model chaining
-        img = rlt.astype("uint8")
-
-        if self.seamless:
-            rlt = self.crop_seamless(rlt, final_scale)
+        # Tiling (and the seamless modes, which only change how tiles are padded at
+        # the image border) happens below the alpha handling, see _tiled_upscale
+        rlt = self.upscale(img)
+        if rlt.shape[2] == 1:  # grayscale model, hand back a grayscale image
+            rlt = rlt[:, :, 0]
 
         # We use imencode instead of imwrite to work around Unicode breakage on Windows.
         # See https://jdhao.github.io/2019/09/11/opencv_unicode_image_path/
         # is_success, im_buf_arr = cv2.imencode(".png", rlt)
         # if not is_success:
         #     raise Exception('cv2.imencode failure')
-        rlt = rlt.astype(np.uint8)  # Ensure rlt is of type uint8        
+        if self.return_type == ReturnType.NDARRAY:
+            return rlt
+        elif self.return_type == ReturnType.TENSOR:
+            return torch.from_numpy(rlt)
         img_output = Image.fromarray(rlt)
         return img_output
 
     # This code is a somewhat modified version of BlueAmulet's fork of ESRGAN by Xinntao
+    @torch.inference_mode()
     def process(self, img: np.ndarray):
         """
-        Does the processing part of ESRGAN. This method only exists because the same block of code needs to be ran twice for images with transparency.
+        Does the processing part of ESRGAN. Queues a whole batch of tiles through the model without waiting for it to finish.
+
+                Parameters:
+                        img (array): The batch of tiles to process, shaped (N, H, W, C)
+
+                Returns:
+                        pending (tuple): The queued batch, pass it to _finish to get the result
+        """
+        # OpenCV's HWC layout is exactly channels_last, so this is only a stride
+        # reinterpretation, not a transpose
+        img_LR = torch.from_numpy(np.ascontiguousarray(img)).permute(0, 3, 1, 2)
+        n = img_LR.shape[0]
+
+        with self._autocast():
+            if self.cpu:
+                img_LR = img_LR.float().contiguous(memory_format=torch.channels_last)
+                output = self._to_uint8(self.model(self._swap_channels(img_LR)))
+                return self._swap_channels(output), None
+
+            # Staging buffers are allocated on first use and kept while the tile shape holds
+            if (
+                not self._slots
+                or self._slots[0]["host_in"].shape[1:] != img_LR.shape[1:]
+                or self._slots[0]["host_in"].shape[0] < n
+            ):
+                self._allocate_buffers(*img_LR.shape)
+
+            slot = self._slots[self._slot]
+            # The slot was last used two batches ago; make sure it's free before reusing it
+            if slot["done"] is not None:
+                slot["done"].synchronize()
+            host_in = slot["host_in"][:n]
+            gpu_in = slot["gpu_in"][:n]
+            host_out = slot["host_out"][:n]
+            host_in.copy_(img_LR)
+
+            with torch.cuda.stream(self._h2d_stream):
+                gpu_in.copy_(host_in, non_blocking=True)
+                copied = torch.cuda.Event()
+                copied.record()
+
+            # Weights are uploaded on the default stream
+            self._compute_stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self._compute_stream):
+                self._compute_stream.wait_event(copied)
+                # Quantize before the D2H copy, uint8 is a quarter of the PCIe traffic
+                output = self._to_uint8(self.model(self._swap_channels(gpu_in)))
+                self._swap_channels(output)
+                computed = torch.cuda.Event()
+                computed.record()
+
+            with torch.cuda.stream(self._d2h_stream):
+                self._d2h_stream.wait_event(computed)
+                output.record_stream(self._d2h_stream)
+                host_out.copy_(output, non_blocking=True)
+                slot["done"] = torch.cuda.Event()
+                slot["done"].record()
+
+            # Only hand the slot over once the batch is queued, an OOM above must
+            # not leave the in-flight batch's slot up for reuse
+            self._slot ^= 1
+
+        return host_out, slot["done"]
+
+    def _autocast(self) -> torch.autocast:
+        # Scoped mixed precision instead of a global half default tensor type
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=torch.float16,
+            enabled=self.fp16 and not self.cpu,
+        )
+
+    @staticmethod
+    def _to_uint8(output: torch.Tensor) -> torch.Tensor:
+        return output.clamp_(0, 1).mul_(255.0).add_(0.5).to(torch.uint8)
+
+    @staticmethod
+    def _swap_channels(img: torch.Tensor) -> torch.Tensor:
+        # BGR(A) <-> RGB(A) in place on whatever device the batch lives on.
+        # flip keeps the channels_last layout, index_select would not.
+        if img.shape[1] in (3, 4):
+            img[:, :3] = img[:, :3].flip(1)
+        return img
+
+    def _allocate_buffers(self, batch: int, channels: int, height: int, width: int):
+        """
+        (Re)allocates the staging buffers of both slots for tiles of the given shape, so batches are copied into them instead of allocating fresh tensors each time.
+        """
+        for slot in self._slots:
+            if slot["done"] is not None:
+                slot["done"].synchronize()
+        model_dtype = torch.float16 if self.fp16 else torch.float32
+        # Build the new slots first so an OOM here leaves the old ones usable
+        slots = []
+        for _ in range(2):
+            gpu_in = torch.empty(
+                (batch, channels, height, width),
+                device=self.device,
+                dtype=model_dtype,
+                memory_format=torch.channels_last,
+            )
+            slots.append(
+                {
+                    "gpu_in": gpu_in,
+                    # Same NHWC strides as gpu_in so the upload is a straight copy
+                    "host_in": torch.empty_like(gpu_in, device="cpu", pin_memory=True),
+                    "host_out": torch.empty(
+                        (
+                            batch,
+                            self.last_out_nc,
+                            height * self.last_scale,
+                            width * self.last_scale,
+                        ),
+                        dtype=torch.uint8,
+                        memory_format=torch.channels_last,
+                        pin_memory=True,
+                    ),
+                    "done": None,
+                }
+            )
+        self._slots = slots
+        self._slot = 0
+
+    def _finish(self, pending) -> np.ndarray:
+        """
+        Waits for a batch queued by process and converts it back to an image batch.
+        The result may share memory with a staging buffer, so use it before queueing two more batches.
+
+                Parameters:
+                        pending (tuple): The value returned by process
+
+                Returns:
+                        rlt (array): The processed uint8 batch, shaped (N, H * scale, W * scale, C)
+        """
+        output, done = pending
+        if done is not None:
+            done.synchronize()
+        # Back to NHWC, contiguous as long as the output was channels_last
+        output = output.permute(0, 2, 3, 1).numpy()
+        return output
+
+    def _tiled_upscale(
+        self, img: np.ndarray, border_value: Tuple[float, ...] = (0.0, 0.0, 0.0, 0.0)
+    ) -> np.ndarray:
+        """
+        Runs the model over a fixed grid of overlapping tiles and blends them back together with a Gaussian weight, so interior joins don't leave seams.
 
                 Parameters:
                         img (array): The image to process
+                        border_value (tuple): Per-channel fill for the ALPHA_PAD border
 
                 Returns:
-                        rlt (array): The processed image
+                        output (array): The processed image
         """
-        if img.shape[2] == 3:
-            img = img[:, :, [2, 1, 0]]
-        elif img.shape[2] == 4:
-            img = img[:, :, [2, 1, 0, 3]]
-        img = torch.from_numpy(np.transpose(img, (2, 0, 1))).float()
-        if self.fp16:
-            img = img.half()
-        img_LR = img.unsqueeze(0)
-        img_LR = img_LR.to(self.device)
-
-        output = self.model(img_LR).data.squeeze(0).float().cpu().clamp_(0, 1).numpy()
-        if output.shape[0] == 3:
-            output = output[[2, 1, 0], :, :]
-        elif output.shape[0] == 4:
-            output = output[[2, 1, 0, 3], :, :]
-        output = np.transpose(output, (1, 2, 0))
+        img_height, img_width = img.shape[:2]
+        scale = self.last_scale
+        pad = self.tile_pad
+
+        if self.tile_size <= 2 * pad:
+            raise ValueError("tile_size must be larger than 2 * tile_pad")
+        tile_height = self._tile_side(img_height)
+        tile_width = self._tile_side(img_width)
+        stride_y = tile_height - 2 * pad
+        stride_x = tile_width - 2 * pad
+
+        # Last row/column is shifted back so only the pad leaves the image, unless
+        # a single tile is larger than the whole image
+        ys = list(range(0, img_height, stride_y))
+        xs = list(range(0, img_width, stride_x))
+        ys[-1] = max(img_height - stride_y, 0)
+        xs[-1] = max(img_width - stride_x, 0)
+        tiles = [
+            (y - pad, y + stride_y + pad, x - pad, x + stride_x + pad)
+            for y in ys
+            for x in xs
+        ]
+
+        weight = ops.gaussian_weight(tile_height * scale, tile_width * scale)
+
+        output = None
+        weight_sum = np.zeros((img_height * scale, img_width * scale, 1), np.float32)
+
+        def blend(batch, batch_output):
+            nonlocal output
+            if output is None:
+                output = np.zeros(
+                    (img_height * scale, img_width * scale, batch_output.shape[3]),
+                    np.float32,
+                )
+            for (y0, y1, x0, x1), tile_output in zip(batch, batch_output):
+                # Drop the parts of the tile that fall outside the image
+                oy0, oy1 = max(y0, 0) * scale, min(y1, img_height) * scale
+                ox0, ox1 = max(x0, 0) * scale, min(x1, img_width) * scale
+                ty0, tx0 = oy0 - y0 * scale, ox0 - x0 * scale
+                ty1, tx1 = ty0 + (oy1 - oy0), tx0 + (ox1 - ox0)
+                # Tiles come back as uint8, the 1/255 is folded into the blend
+                ops.blend_tile(
+                    output[oy0:oy1, ox0:ox1],
+                    weight_sum[oy0:oy1, ox0:ox1],
+                    tile_output[ty0:ty1, tx0:tx1],
+                    weight[ty0:ty1, tx0:tx1],
+                    np.float32(1.0 / 255.0),
+                )
+
+        # Blend the previous batch while the GPU works on the current one
+        in_flight = None
+        i = 0
+        while i < len(tiles):
+            batch = tiles[i : i + self.batch_size]
+            try:
+                pending = self.process(
+                    np.stack([self._read_tile(img, *tile, border_value) for tile in batch])
+                )
+            except torch.cuda.OutOfMemoryError:
+                if self.batch_size == 1:
+                    raise
+                # Collect garbage (clear VRAM) and retry with a smaller batch
+                torch.cuda.empty_cache()
+                gc.collect()
+                self.batch_size //= 2
+                self.log.warning(
+                    f"Out of VRAM, reducing tile batch size to {self.batch_size}"
+                )
+                continue
+            if in_flight is not None:
+                blend(in_flight[0], self._finish(in_flight[1]))
+            in_flight = (batch, pending)
+            i += len(batch)
+        blend(in_flight[0], self._finish(in_flight[1]))
+
+        output /= weight_sum
         return output
 
+    def _tile_side(self, size: int) -> int:
+        # Spread the image evenly over as few tiles as fit, so an image just over one
+        # tile doesn't run a second, mostly padded one
+        pad = self.tile_pad
+        n = math.ceil(size / (self.tile_size - 2 * pad))
+        side = math.ceil(size / n) + 2 * pad
+        if not self.cpu:
+            # Round up to a multiple of 64 so cuDNN benchmarks a bounded set of
+            # shapes instead of one per image size
+            side = min(math.ceil(side / 64) * 64, self.tile_size)
+        return side
+
+    def _border_type(self) -> int:
+        # How tiles are padded where they hang over the image border. Tiling
+        # wraps around the whole image, so _read_tile handles it separately
+        if self.seamless == SeamlessOptions.REPLICATE:
+            return cv2.BORDER_REPLICATE
+        elif self.seamless == SeamlessOptions.ALPHA_PAD:
+            return cv2.BORDER_CONSTANT
+        # Mirror, and the default for non-seamless images
+        return cv2.BORDER_REFLECT_101
+
+    def _read_tile(
+        self,
+        img: np.ndarray,
+        y0: int,
+        y1: int,
+        x0: int,
+        x1: int,
+        border_value: Tuple[float, ...],
+    ) -> np.ndarray:
+        img_height, img_width = img.shape[:2]
+        tile = img[max(y0, 0) : min(y1, img_height), max(x0, 0) : min(x1, img_width)]
+        if tile.shape[:2] == (y1 - y0, x1 - x0):
+            return tile
+        if self.seamless == SeamlessOptions.TILE:
+            # Wrapping has to go around the whole image, not around the tile
+            rows = np.arange(y0, y1) % img_height
+            cols = np.arange(x0, x1) % img_width
+            return img[np.ix_(rows, cols)]
+        tile = cv2.copyMakeBorder(
+            tile,
+            max(-y0, 0),
+            max(y1 - img_height, 0),
+            max(-x0, 0),
+            max(x1 - img_width, 0),
+            self._border_type(),
+            value=border_value,
+        )
+        if tile.ndim == 2:  # copyMakeBorder drops a single channel axis
+            tile = tile[:, :, None]
+        return tile
+
     def load_model(self, model_path: str):
+        compiled = False
         if model_path != self.last_model:
-            # interpolating OTF, example: 4xBox:25&4xPSNR:75
-            if (":" in model_path or "@" in model_path) and (
-                "&" in model_path or "|" in model_path
-            ):
-                interps = model_path.split("&")[:2]
-                model_1 = torch.load(interps[0].split("@")[0])
-                model_2 = torch.load(interps[1].split("@")[0])
-                state_dict = OrderedDict()
-                for k, v_1 in model_1.items():
-                    v_2 = model_2[k]
-                    state_dict[k] = (int(interps[0].split("@")[1]) / 100) * v_1 + (
-                        int(interps[1].split("@")[1]) / 100
-                    ) * v_2
-            else:
-                state_dict = torch.load(model_path)
-
+            # Models are shared between instances, so serving many images doesn't
+            # reload and re-upload the checkpoint every time
+            key = (model_path, str(self.device), self.fp16, self.compile_model)
+            self.model = _MODEL_CACHE.get(key)
+            compiled = self.model is None and self.compile_model
+            if self.model is None:
+                self.model = self._build_model(model_path)
+                self.model.eval()
+                self.model = self.model.to(self.device)
+                # NHWC layout lets cuDNN pick the Tensor Core kernels
+                self.model = self.model.to(memory_format=torch.channels_last)
+                if self.fp16 and not self.cpu:
+                    self.model.half()
+                if self.compile_model:
+                    # Fuses the conv + bias + activation chains. CUDA graphs
+                    # (mode="reduce-overhead") are left off: they'd overwrite the
+                    # output of a batch that is still being copied back on the side stream.
+                    # Dynamic shapes, so smaller tile buckets and partial batches reuse
+                    # the graph compiled during warmup instead of recompiling
+                    self.model = torch.compile(self.model, dynamic=True)
+                _MODEL_CACHE[key] = self.model
+
+            # torch.compile wraps the module, the attributes live on the original
+            model = getattr(self.model, "_orig_mod", self.model)
             # SRVGGNet Real-ESRGAN (v2)
-            if (
-                "params" in state_dict.keys()
-                and "body.0.weight" in state_dict["params"].keys()
-            ):
-                self.model = RealESRGANv2(state_dict)
-                self.last_in_nc = self.model.num_in_ch
-                self.last_out_nc = self.model.num_out_ch
-                self.last_nf = self.model.num_feat
-                self.last_nb = self.model.num_conv
-                self.last_scale = self.model.scale
-                self.last_model = model_path
-            # SPSR (ESRGAN with lots of extra layers)
-            elif "f_HR_conv1.0.weight" in state_dict:
-                self.model = SPSR(state_dict)
-                self.last_in_nc = self.model.in_nc
-                self.last_out_nc = self.model.out_nc
-                self.last_nf = self.model.num_filters
-                self.last_nb = self.model.num_blocks
-                self.last_scale = self.model.scale
-                self.last_model = model_path
-            # Regular ESRGAN, "new-arch" ESRGAN, Real-ESRGAN v1
+            if isinstance(model, RealESRGANv2):
+                self.last_in_nc = model.num_in_ch
+                self.last_out_nc = model.num_out_ch
+                self.last_nf = model.num_feat
+                self.last_nb = model.num_conv
+            # SPSR, regular ESRGAN, "new-arch" ESRGAN, Real-ESRGAN v1
             else:
-                self.model = ESRGAN(state_dict)
-                self.last_in_nc = self.model.in_nc
-                self.last_out_nc = self.model.out_nc
-                self.last_nf = self.model.num_filters
-                self.last_nb = self.model.num_blocks
-                self.last_scale = self.model.scale
-                self.last_model = model_path
-
-            del state_dict
-        self.model.eval()
-        for k, v in self.model.named_parameters():
-            v.requires_grad = False
-        self.model = self.model.to(self.device)
-        self.last_model = model_path
+                self.last_in_nc = model.in_nc
+                self.last_out_nc = model.out_nc
+                self.last_nf = model.num_filters
+                self.last_nb = model.num_blocks
+            self.last_scale = model.scale
+            self.last_model = model_path
+
+        if compiled:
+            # Compile (and let cuDNN benchmark) up front, on a full tile batch
+            self._allocate_buffers(
+                self.batch_size, self.last_in_nc, self.tile_size, self.tile_size
+            )
+            with torch.inference_mode(), self._autocast():
+                self.model(self._slots[0]["gpu_in"])
+
+    @staticmethod
+    def _load_state_dict(path: str):
+        try:
+            # mmap keeps the checkpoint out of RAM until the weights are actually read
+            return torch.load(path, map_location="cpu", weights_only=True, mmap=True)
+        except RuntimeError:
+            # Checkpoints saved in the legacy (non-zip) format can't be mmapped
+            return torch.load(path, map_location="cpu", weights_only=True)
+
+    def _build_model(self, model_path: str) -> torch.nn.Module:
+        # interpolating OTF, example: 4xBox:25&4xPSNR:75
+        if (":" in model_path or "@" in model_path) and (
+            "&" in model_path or "|" in model_path
+        ):
+            interps = model_path.split("&")[:2]
+            model_1 = self._load_state_dict(interps[0].split("@")[0])
+            model_2 = self._load_state_dict(interps[1].split("@")[0])
+            a = int(interps[0].split("@")[1]) / 100
+            b = int(interps[1].split("@")[1]) / 100
+            # a * v_1 + b * v_2 over every parameter in one multi-tensor kernel
+            keys = list(model_1.keys())
+            merged = torch._foreach_add(
+                torch._foreach_mul([model_1[k] for k in keys], a),
+                [model_2[k] for k in keys],
+                alpha=b,
+            )
+            state_dict = OrderedDict(zip(keys, merged))
+        else:
+            state_dict = self._load_state_dict(model_path)
+
+        # SRVGGNet Real-ESRGAN (v2)
+        if (
+            "params" in state_dict.keys()
+            and "body.0.weight" in state_dict["params"].keys()
+        ):
+            return RealESRGANv2(state_dict)
+        # SPSR (ESRGAN with lots of extra layers)
+        elif "f_HR_conv1.0.weight" in state_dict:
+            return SPSR(state_dict)
+        # Regular ESRGAN, "new-arch" ESRGAN, Real-ESRGAN v1
+        else:
+            return ESRGAN(state_dict)
 
     # This code is a somewhat modified version of BlueAmulet's fork of ESRGAN by Xinntao
     def upscale(self, img: np.ndarray) -> np.ndarray:
@@ -261,7 +575,10 @@ class Upscale:
                         output: The processed image
         """
 
-        img = img * 1.0 / np.iinfo(img.dtype).max
+        img = ops.normalize_image(img)
+        if img.ndim == 2:
+            # Channels are only replicated below, if the model wants more than one
+            img = img[:, :, None]
 
         if (
             img.ndim == 3
@@ -272,49 +589,34 @@ class Upscale:
 
             # Fill alpha with white and with black, remove the difference
             if self.alpha_mode == AlphaOptions.BG_DIFFERENCE:
-                img1 = np.copy(img[:, :, :3])
-                img2 = np.copy(img[:, :, :3])
-                for c in range(3):
-                    img1[:, :, c] *= img[:, :, 3]
-                    img2[:, :, c] = (img2[:, :, c] - 1) * img[:, :, 3] + 1
-
-                output1 = self.process(img1)
-                output2 = self.process(img2)
+                alpha = img[:, :, 3:4]  # (H, W, 1), broadcasts over the colour channels
+                img1 = img[:, :, :3] * alpha
+                img2 = (img[:, :, :3] - 1.0) * alpha + 1.0
+
+                output1 = self._tiled_upscale(img1)
+                # A transparent border composites to white on the white background
+                output2 = self._tiled_upscale(img2, border_value=(1.0, 1.0, 1.0, 1.0))
                 alpha = 1 - np.mean(output2 - output1, axis=2)
-                output = np.dstack((output1, alpha))
-                output = np.clip(output, 0, 1)
+                output = ops.add_alpha(output1, alpha)
+                np.clip(output, 0, 1, out=output)
             # Upscale the alpha channel itself as its own image
             elif self.alpha_mode == AlphaOptions.ALPHA_SEPARATELY:
-                img1 = np.copy(img[:, :, :3])
-                img2 = cv2.merge((img[:, :, 3], img[:, :, 3], img[:, :, 3]))
-                output1 = self.process(img1)
-                output2 = self.process(img2)
-                output = cv2.merge(
-                    (
-                        output1[:, :, 0],
-                        output1[:, :, 1],
-                        output1[:, :, 2],
-                        output2[:, :, 0],
-                    )
-                )
+                img1 = np.ascontiguousarray(img[:, :, :3])
+                img2 = np.repeat(img[:, :, 3:4], 3, axis=2)
+                output1 = self._tiled_upscale(img1)
+                output2 = self._tiled_upscale(img2)
+                output = ops.add_alpha(output1, output2[:, :, 0])
             # Use the alpha channel like a regular channel
             elif self.alpha_mode == AlphaOptions.SWAPPING:
-                img1 = cv2.merge((img[:, :, 0], img[:, :, 1], img[:, :, 2]))
-                img2 = cv2.merge((img[:, :, 1], img[:, :, 2], img[:, :, 3]))
-                output1 = self.process(img1)
-                output2 = self.process(img2)
-                output = cv2.merge(
-                    (
-                        output1[:, :, 0],
-                        output1[:, :, 1],
-                        output1[:, :, 2],
-                        output2[:, :, 2],
-                    )
-                )
+                img1 = np.ascontiguousarray(img[:, :, :3])
+                img2 = np.ascontiguousarray(img[:, :, 1:])
+                output1 = self._tiled_upscale(img1)
+                output2 = self._tiled_upscale(img2)
+                output = ops.add_alpha(output1, output2[:, :, 2])
             # Remove alpha
             else:
-                img1 = np.copy(img[:, :, :3])
-                output = self.process(img1)
+                img1 = np.ascontiguousarray(img[:, :, :3])
+                output = self._tiled_upscale(img1)
                 output = cv2.cvtColor(output, cv2.COLOR_BGR2BGRA)
 
             if self.binary_alpha:
@@ -330,34 +632,32 @@ class Upscale:
                 half_transparent_upper_bound = (
                     self.alpha_threshold + self.alpha_boundary_offset
                 )
-                alpha = np.where(
-                    alpha < half_transparent_lower_bound,
-                    0,
-                    np.where(alpha <= half_transparent_upper_bound, 0.5, 1),
+                # Each threshold contributes half: 0 below, 0.5 between, 1 above
+                _, lower = cv2.threshold(
+                    alpha, half_transparent_lower_bound, 0.5, cv2.THRESH_BINARY
                 )
-                output[:, :, 3] = alpha
-        else:
-            if img.ndim == 2:
-                img = np.tile(
-                    np.expand_dims(img, axis=2), (1, 1, min(self.last_in_nc, 3))
+                _, upper = cv2.threshold(
+                    alpha, half_transparent_upper_bound, 0.5, cv2.THRESH_BINARY
                 )
+                output[:, :, 3] = cv2.add(lower, upper)
+        else:
+            if img.shape[2] == 1 and self.last_in_nc > 1:
+                img = np.broadcast_to(
+                    img, img.shape[:2] + (min(self.last_in_nc, 3),)
+                ).copy()
+            border_value = (0.0, 0.0, 0.0, 0.0)
             if img.shape[2] > self.last_in_nc:  # remove extra channels
                 self.log.warning("Truncating image channels")
                 img = img[:, :, : self.last_in_nc]
             # pad with solid alpha channel
             elif img.shape[2] == 3 and self.last_in_nc == 4:
-                img = np.dstack((img, np.full(img.shape[:-1], 1.0)))
-            output = self.process(img)
+                img = ops.add_alpha(img, 1.0)
+                # The solid alpha extends over the ALPHA_PAD border, the colour doesn't
+                border_value = (0.0, 0.0, 0.0, 1.0)
+            output = self._tiled_upscale(img, border_value)
 
-        output = (output * 255.0).round()
+        output = ops.quantize_image(output)
 
         return output
 
-    def crop_seamless(self, img: np.ndarray, scale: int) -> np.ndarray:
-        img_height, img_width = img.shape[:2]
-        y, x = 16 * scale, 16 * scale
-        h, w = img_height - (32 * scale), img_width - (32 * scale)
-        img = img[y : y + h, x : x + w]
-        return img
-
 
@@ -5,6 +5,7 @@ import gc
 
 import numpy as np
 import torch
+from numba import njit, prange
 
 
 def bgr_to_rgb(image: torch.Tensor) -> torch.Tensor:
@@ -30,6 +31,82 @@ def rgba_to_bgra(image: torch.Tensor) -> torch.Tensor:
     return bgra_to_rgba(image)
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _normalize(src: np.ndarray, dst: np.ndarray, scale: float):
+    for i in prange(src.size):
+        dst[i] = src[i] * scale
+
+
+def normalize_image(img: np.ndarray) -> np.ndarray:
+    # integer image -> float32 in [0, 1], in a single parallel pass.
+    # Float images are taken to already be in [0, 1]
+    if np.issubdtype(img.dtype, np.floating):
+        return np.ascontiguousarray(img, dtype=np.float32)
+    img = np.ascontiguousarray(img)
+    out = np.empty(img.shape, np.float32)
+    scale = np.float32(1.0 / np.iinfo(img.dtype).max)
+    _normalize(img.reshape(-1), out.reshape(-1), scale)
+    return out
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _quantize(src: np.ndarray, dst: np.ndarray):
+    for i in prange(src.size):
+        v = src[i] * 255.0 + 0.5
+        if v < 0:
+            v = 0
+        elif v > 255:
+            v = 255
+        dst[i] = np.uint8(v)
+
+
+def quantize_image(img: np.ndarray) -> np.ndarray:
+    # float image in [0, 1] -> uint8, scale/round/clip/cast fused into one parallel pass
+    img = np.ascontiguousarray(img)
+    out = np.empty(img.shape, np.uint8)
+    _quantize(img.reshape(-1), out.reshape(-1))
+    return out
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def blend_tile(
+    output: np.ndarray,
+    weight_sum: np.ndarray,
+    tile: np.ndarray,
+    weight: np.ndarray,
+    tile_scale: float,
+):
+    # output += tile * tile_scale * weight and weight_sum += weight, in place and in
+    # one pass, without the temporaries of the equivalent NumPy expressions
+    height, width, channels = tile.shape
+    for y in prange(height):
+        for x in range(width):
+            w = weight[y, x, 0]
+            for c in range(channels):
+                output[y, x, c] += tile[y, x, c] * tile_scale * w
+            weight_sum[y, x, 0] += w
+
+
+def add_alpha(img: np.ndarray, alpha) -> np.ndarray:
+    # HxWx3 + HxW (or scalar) alpha -> HxWx4, written straight into one buffer
+    # instead of np.dstack/cv2.merge copying each channel into a fresh array
+    out = np.empty(img.shape[:2] + (4,), img.dtype)
+    out[:, :, :3] = img
+    out[:, :, 3] = alpha
+    return out
+
+
+def gaussian_weight(height: int, width: int) -> np.ndarray:
+    # 2D Gaussian blending mask, peaks in the middle of the tile and falls off
+    # towards (but never reaches) zero at the edges
+    def gaussian(size: int) -> np.ndarray:
+        sigma = size / 4
+        return np.exp(-(((np.arange(size) + 0.5 - size / 2) / sigma) ** 2))
+
+    weight = np.outer(gaussian(height), gaussian(width)).astype(np.float32)
+    return weight[:, :, None]
+
+
 def auto_split_upscale(
     lr_img: np.ndarray,
     upscale_function,